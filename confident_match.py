@@ -0,0 +1,247 @@
+import json
+import re
+from json_convert import STOP_WORDS
+
+# Calibrated on reference_results.json; used when no reference results are available
+DEFAULT_THRESHOLDS = {
+    "similarity": 0.5,
+    "similarity_gap": 0.2
+}
+
+# Exponent applied to a code's subclass score relative to the top subclass, so codes
+# from a subclass that top_class_search clearly ranked lower are trusted less
+CLASS_SCORE_WEIGHT = 0.5
+
+# Agreement with the reference that calibrated thresholds must reach
+TARGET_AGREEMENT = 0.99
+
+# Thresholds no candidate can meet, used when calibration cannot reach the target
+NO_OFFLOAD_THRESHOLDS = {
+    "similarity": float("inf"),
+    "similarity_gap": float("inf")
+}
+
+# Threshold grid searched during calibration
+SIMILARITY_GRID = [0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+SIMILARITY_GAP_GRID = [0.0, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3]
+
+def normalize_diagnosis(diagnosis):
+    # The LLM echoes the diagnosis with surrounding quotes; strip them so results line up
+    return diagnosis.strip().strip("'\"")
+
+def content_words(text):
+    return {word for word in re.findall(r'\b\w+\b', text.lower()) if word not in STOP_WORDS}
+
+def jaccard_similarity(words1, words2):
+    union = words1 | words2
+    return len(words1 & words2) / len(union) if union else 0.0
+
+def score_candidates(diagnosis, class_scores, codes, icd10_data):
+    """Return the best candidate code for a diagnosis and the signals used to trust it.
+
+    similarity is the word overlap of a code with the diagnosis, weighted by how its
+    subclass score from top_class_search compares to the top subclass, and
+    similarity_gap is how far the best code leads the next best candidate.
+    """
+    top_score = max((info["score"] for info in class_scores.values()), default=0)
+    if top_score <= 0:
+        return None
+
+    def weighted_similarity(code, description):
+        class_weight = (class_scores.get(code.split('.')[0], {}).get("score", 0) / top_score) ** CLASS_SCORE_WEIGHT
+        return jaccard_similarity(diagnosis_words, content_words(description)) * class_weight
+
+    diagnosis_words = content_words(diagnosis)
+    # Ties prefer the longer, more specific code
+    ranked = sorted(
+        ((weighted_similarity(code, description), len(code), code) for code, description in codes.items()),
+        reverse=True
+    )
+    if not ranked:
+        return None
+    similarity, _, code = ranked[0]
+    similarity_gap = similarity - (ranked[1][0] if len(ranked) > 1 else 0)
+
+    # A class that still has specifics is never a final answer on its own
+    is_leaf = '.' in code or not icd10_data.get(code, {}).get("specifics")
+
+    return {
+        "code": code,
+        "leaf": is_leaf,
+        "similarity": similarity,
+        "similarity_gap": similarity_gap
+    }
+
+def is_confident(candidate, thresholds):
+    return (
+        candidate is not None
+        and candidate["leaf"]
+        and candidate["similarity"] >= thresholds["similarity"]
+        and candidate["similarity_gap"] >= thresholds["similarity_gap"]
+    )
+
+def score_all(top_results, converted_data, icd10_data):
+    # Both files list diagnoses per patient in the same order
+    scored = {}
+    for patient_id, entries in converted_data.items():
+        top_entries = top_results.get(patient_id, [])
+        if len(top_entries) != len(entries):
+            raise ValueError(
+                f"Patient {patient_id} has {len(entries)} converted diagnoses but "
+                f"{len(top_entries)} top subclass results; regenerate both files from the same input"
+            )
+        scored[patient_id] = []
+        for top_entry, entry in zip(top_entries, entries):
+            candidate = score_candidates(entry["diagnosis"], top_entry["codes"], entry["codes"], icd10_data)
+            scored[patient_id].append((entry, candidate))
+    return scored
+
+def load_reference_codes(reference_json_path):
+    with open(reference_json_path, 'r') as reference_file:
+        reference_data = json.load(reference_file)
+
+    reference_codes = {}
+    for patient_id, results in reference_data.items():
+        reference_codes[patient_id] = {
+            normalize_diagnosis(result["diagnosis"]): result["code"] for result in results
+        }
+    return reference_codes
+
+def evaluate(scored, reference_codes, thresholds, patient_ids):
+    total = offloaded = agreed = 0
+    for patient_id in patient_ids:
+        references = reference_codes.get(patient_id, {})
+        for entry, candidate in scored[patient_id]:
+            diagnosis = normalize_diagnosis(entry["diagnosis"])
+            if diagnosis not in references:
+                continue
+            total += 1
+            if is_confident(candidate, thresholds):
+                offloaded += 1
+                agreed += candidate["code"] == references[diagnosis]
+
+    offload_rate = offloaded / total if total > 0 else 0.0
+    # Agreement is undefined when nothing was offloaded
+    agreement_rate = agreed / offloaded if offloaded > 0 else None
+    return offload_rate, agreement_rate
+
+def calibrate(scored, reference_codes, patient_ids, target_agreement=TARGET_AGREEMENT):
+    # Pick the thresholds that offload the most diagnoses while keeping agreement with the
+    # reference; returns None when no point on the grid reaches the target
+    best_thresholds, best_offload = None, -1.0
+    for similarity in SIMILARITY_GRID:
+        for similarity_gap in SIMILARITY_GAP_GRID:
+            thresholds = {
+                "similarity": similarity,
+                "similarity_gap": similarity_gap
+            }
+            offload_rate, agreement_rate = evaluate(scored, reference_codes, thresholds, patient_ids)
+            if agreement_rate is not None and agreement_rate >= target_agreement and offload_rate > best_offload:
+                best_thresholds, best_offload = thresholds, offload_rate
+    return best_thresholds
+
+def split_by_confidence(scored, thresholds):
+    """Split diagnoses into results accepted on the fast path and those left for the LLM."""
+    confident_results, remaining = {}, {}
+    for patient_id, entries in scored.items():
+        confident_results[patient_id] = []
+        remaining[patient_id] = []
+        for entry, candidate in entries:
+            if is_confident(candidate, thresholds):
+                confident_results[patient_id].append({
+                    "diagnosis": entry["diagnosis"],
+                    "code": candidate["code"],
+                    "reason": (
+                        f"Accepted without LLM: similarity {candidate['similarity']:.2f}, "
+                        f"lead over next code {candidate['similarity_gap']:.2f}."
+                    )
+                })
+            else:
+                remaining[patient_id].append(entry)
+    return confident_results, remaining
+
+def merge_results(converted_json_path, confident_json_path, llm_json_path, output_json_path):
+    """Combine fast-path and LLM results in the diagnosis order of the converted input."""
+    with open(converted_json_path, 'r') as converted_file:
+        converted_data = json.load(converted_file)
+
+    # Index both result files by patient and normalized diagnosis
+    results_by_diagnosis = {}
+    for results_json_path in (llm_json_path, confident_json_path):
+        with open(results_json_path, 'r') as results_file:
+            for patient_id, results in json.load(results_file).items():
+                for result in results:
+                    results_by_diagnosis[(patient_id, normalize_diagnosis(result["diagnosis"]))] = result
+
+    merged, missing = {}, 0
+    for patient_id, entries in converted_data.items():
+        merged[patient_id] = []
+        for entry in entries:
+            diagnosis = normalize_diagnosis(entry["diagnosis"])
+            result = results_by_diagnosis.get((patient_id, diagnosis))
+            if result is None:
+                missing += 1
+                continue
+            merged[patient_id].append({
+                "diagnosis": diagnosis,
+                "code": result["code"],
+                "reason": result["reason"]
+            })
+
+    with open(output_json_path, 'w') as output_file:
+        json.dump(merged, output_file, indent=4)
+
+    if missing:
+        print(f"Warning: {missing} diagnoses have no result in either file")
+    print(f"Merged results saved to {output_json_path}")
+
+def main(converted_json_path, top_results_json_path, reference_json_path, confident_json_path, remaining_json_path):
+    with open(converted_json_path, 'r') as converted_file:
+        converted_data = json.load(converted_file)
+    with open(top_results_json_path, 'r') as top_file:
+        top_results = json.load(top_file)
+    with open('icd10_data.json', 'r') as data_file:
+        icd10_data = json.load(data_file)
+
+    scored = score_all(top_results, converted_data, icd10_data)
+
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    if reference_json_path:
+        reference_codes = load_reference_codes(reference_json_path)
+
+        # Calibrate on half of the patients and report agreement on the other half
+        patient_ids = sorted(scored, key=int)
+        calibration_ids, holdout_ids = patient_ids[::2], patient_ids[1::2]
+        thresholds = calibrate(scored, reference_codes, calibration_ids)
+
+        if thresholds is None:
+            print(f"Warning: no thresholds reach {TARGET_AGREEMENT:.0%} agreement with the reference; "
+                  "sending every diagnosis to the LLM")
+            thresholds = dict(NO_OFFLOAD_THRESHOLDS)
+        else:
+            print(f"Calibrated thresholds: {thresholds}")
+        for label, ids in (("Calibration", calibration_ids), ("Held-out", holdout_ids), ("All", patient_ids)):
+            offload_rate, agreement_rate = evaluate(scored, reference_codes, thresholds, ids)
+            agreement = f"{agreement_rate:.1%}" if agreement_rate is not None else "n/a"
+            print(f"{label} patients: offloaded {offload_rate:.1%}, agreement with reference {agreement}")
+
+    confident_results, remaining = split_by_confidence(scored, thresholds)
+
+    with open(confident_json_path, 'w') as confident_file:
+        json.dump(confident_results, confident_file, indent=4)
+    with open(remaining_json_path, 'w') as remaining_file:
+        json.dump(remaining, remaining_file, indent=4)
+
+    confident_count = sum(len(results) for results in confident_results.values())
+    remaining_count = sum(len(entries) for entries in remaining.values())
+    print(f"{confident_count} diagnoses accepted without LLM, {remaining_count} left for the LLM")
+    print(f"Confident results saved to {confident_json_path}, LLM input saved to {remaining_json_path}")
+
+# Example usage
+if __name__ == "__main__":
+    converted_json_path = 'converted_input.json'  # Candidate codes from json_convert.py
+    top_results_json_path = 'top_subclass_results.json'  # Subclass scores from top_class_search.py
+    reference_json_path = 'reference_results.json'  # Frozen LLM results for every diagnosis, used for calibration
+    confident_json_path = 'confident_results.json'  # Results accepted without the LLM
+    remaining_json_path = 'fetchable.json'  # Input for invoke_LLM.py
+    main(converted_json_path, top_results_json_path, reference_json_path, confident_json_path, remaining_json_path)
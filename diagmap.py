@@ -0,0 +1,204 @@
+import argparse
+import os
+import sys
+import time
+
+# Fallback for process_elapsed_seconds on systems without /proc; misses interpreter startup
+START_TIME = time.perf_counter()
+
+# Wall-clock budget for a single `lookup` from process start, including interpreter
+# startup and loading the frequency and ICD-10 data
+LOOKUP_BUDGET_SECONDS = 0.2
+
+def process_elapsed_seconds():
+    # Returns (seconds since the process started, whether interpreter startup is included)
+    try:
+        with open("/proc/self/stat") as stat_file:
+            # The command name may contain spaces, so count fields from after its closing ")"
+            start_ticks = int(stat_file.read().rsplit(")", 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf("SC_CLK_TCK"), True
+    except (OSError, AttributeError, ValueError, IndexError):
+        return time.perf_counter() - START_TIME, False
+
+# Frozen LLM results used to calibrate the fast path and replayed by replay-server
+REFERENCE_JSON_PATH = "reference_results.json"
+
+# Each stage module is imported inside its handler, so a subcommand only pays for
+# the dependencies it needs (NLTK for `specifics`, the Gemini client for `classify --backend gemini`)
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def run_preprocess(args):
+    from preprocess_input_data import convert_csv_to_json
+    convert_csv_to_json(args.input, args.output)
+    print(f"Converted CSV data saved to {args.output}")
+
+def run_build_db(args):
+    import set_database
+    set_database.main(args.input)
+
+def run_class_frequencies(args):
+    import calculate_class_occurence
+    calculate_class_occurence.main(args.input)
+
+def run_global_frequencies(args):
+    import calculate_global_occurence
+    calculate_global_occurence.main(args.input)
+
+def run_custom_weights(args):
+    from custom_weights_score import calculate_relative_frequencies
+    calculate_relative_frequencies(args.input, args.global_frequencies, args.output)
+    print(f"Relative frequencies saved to {args.output}")
+
+def run_top_classes(args):
+    import top_class_search
+    top_class_search.main(args.input, args.output, args.top_k)
+
+def run_specifics(args):
+    import retrieve_top_specifics
+    retrieve_top_specifics.main(args.input, args.output)
+
+def run_convert(args):
+    from json_convert import convert_format
+    convert_format(args.input, args.output)
+
+def run_fast_path(args):
+    import confident_match
+    reference = None if args.no_calibrate else args.reference
+    confident_match.main(args.input, args.top_results, reference, args.confident_output, args.output)
+
+def run_merge(args):
+    from confident_match import merge_results
+    merge_results(args.converted, args.confident, args.llm, args.output)
+
+def run_classify(args):
+    from invoke_LLM import classify_all_diagnoses, get_model
+
+    # Replay runs get their own output so they never replace real LLM results or the recording
+    output = args.output or ("replay_result.json" if args.backend == "replay" else "llm_results.json")
+    if os.path.realpath(output) == os.path.realpath(REFERENCE_JSON_PATH):
+        sys.exit(f"Refusing to overwrite the frozen reference results in {REFERENCE_JSON_PATH}")
+
+    model = get_model(args.backend, args.replay_url)
+    classify_all_diagnoses(args.input, output, args.log, model=model, concurrency=args.concurrency,
+                           request_delay=args.delay, max_retries=args.max_retries, retry_backoff=args.retry_backoff)
+
+def run_replay_server(args):
+    import replay_server
+    replay_server.main(args.recorded, args.host, args.port, args.latency, args.jitter,
+                       args.error_rate, args.rate_limit, args.seed)
+
+def run_lookup(args):
+    import query_search
+    query_search.main(args.diagnosis)
+
+    if args.timing or args.check_budget:
+        elapsed, from_process_start = process_elapsed_seconds()
+        over_budget = elapsed > LOOKUP_BUDGET_SECONDS
+        scope = "since process start" if from_process_start else "excluding interpreter startup"
+        print(f"\nLookup took {elapsed * 1000:.0f} ms {scope} "
+              f"({'OVER' if over_budget else 'within'} the {LOOKUP_BUDGET_SECONDS * 1000:.0f} ms budget)")
+        if args.check_budget and over_budget:
+            sys.exit(1)
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="diagmap", description="DiagMapICD pipeline stages")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sub = subparsers.add_parser("preprocess", help="Step 1: convert the diagnoses CSV to JSON")
+    sub.add_argument("--input", default="Diagnoses_List.csv")
+    sub.add_argument("--output", default="Diagnoses_JSON.json")
+    sub.set_defaults(func=run_preprocess)
+
+    sub = subparsers.add_parser("build-db", help="Step 2: build icd10_data.json from code-description pairs")
+    sub.add_argument("--input", default="code-description pairs.txt")
+    sub.set_defaults(func=run_build_db)
+
+    sub = subparsers.add_parser("class-frequencies", help="Step 3: count word occurrences per class")
+    sub.add_argument("--input", default="icd10_data.json")
+    sub.set_defaults(func=run_class_frequencies)
+
+    sub = subparsers.add_parser("global-frequencies", help="Step 4: count word occurrences across all classes")
+    sub.add_argument("--input", default="icd10_word_frequencies.json")
+    sub.set_defaults(func=run_global_frequencies)
+
+    sub = subparsers.add_parser("custom-weights", help="Step 5: apply the custom scoring weights")
+    sub.add_argument("--input", default="icd10_word_frequencies.json")
+    sub.add_argument("--global-frequencies", default="global_frequency_occurrence.txt")
+    sub.add_argument("--output", default="icd10_word_frequencies_custom.json")
+    sub.set_defaults(func=run_custom_weights)
+
+    sub = subparsers.add_parser("top-classes", help="Step 6: find the top classes per diagnosis")
+    sub.add_argument("--input", default="Diagnoses_JSON.json")
+    sub.add_argument("--output", default="top_subclass_results.json")
+    sub.add_argument("--top-k", type=int, default=3)
+    sub.set_defaults(func=run_top_classes)
+
+    sub = subparsers.add_parser("specifics", help="Step 7: retrieve the top specific codes per class")
+    sub.add_argument("--input", default="top_subclass_results.json")
+    sub.add_argument("--output", default="reduced_match_results.json")
+    sub.set_defaults(func=run_specifics)
+
+    sub = subparsers.add_parser("convert", help="Step 8: compress candidates into the LLM input format")
+    sub.add_argument("--input", default="reduced_match_results.json")
+    sub.add_argument("--output", default="converted_input.json")
+    sub.set_defaults(func=run_convert)
+
+    sub = subparsers.add_parser("fast-path", help="Step 8b: accept confident matches without the LLM")
+    sub.add_argument("--input", default="converted_input.json")
+    sub.add_argument("--top-results", default="top_subclass_results.json")
+    sub.add_argument("--reference", default=REFERENCE_JSON_PATH)
+    sub.add_argument("--no-calibrate", action="store_true", help="use the default thresholds")
+    sub.add_argument("--confident-output", default="confident_results.json")
+    sub.add_argument("--output", default="fetchable.json")
+    sub.set_defaults(func=run_fast_path)
+
+    sub = subparsers.add_parser("classify", help="Step 9: classify the remaining diagnoses with the LLM")
+    sub.add_argument("--input", default="fetchable.json")
+    sub.add_argument("--output", help="defaults to llm_results.json, or replay_result.json with --backend replay")
+    sub.add_argument("--log", default="diagnostic_log.txt")
+    sub.add_argument("--backend", choices=["gemini", "replay"], default="gemini")
+    sub.add_argument("--replay-url", default="http://127.0.0.1:8765")
+    sub.add_argument("--concurrency", type=positive_int, default=1, help="batches sent in parallel")
+    sub.add_argument("--delay", type=float, default=1,
+                     help="minimum seconds between calls, shared by all concurrent workers")
+    sub.add_argument("--max-retries", type=int, default=3)
+    sub.add_argument("--retry-backoff", type=float, default=2, help="first retry delay, doubled each time")
+    sub.set_defaults(func=run_classify)
+
+    sub = subparsers.add_parser("replay-server", help="Serve recorded LLM responses for offline load tests")
+    sub.add_argument("--recorded", default=REFERENCE_JSON_PATH)
+    sub.add_argument("--host", default="127.0.0.1")
+    sub.add_argument("--port", type=int, default=8765)
+    sub.add_argument("--latency", type=float, default=1.0, help="seconds per response")
+    sub.add_argument("--jitter", type=float, default=0.0, help="uniform +/- seconds added to the latency")
+    sub.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+    sub.add_argument("--rate-limit", type=int, default=0, help="requests per second before HTTP 429, 0 for none")
+    sub.add_argument("--seed", type=int, default=0)
+    sub.set_defaults(func=run_replay_server)
+
+    sub = subparsers.add_parser("merge", help="Combine fast-path and LLM results")
+    sub.add_argument("--converted", default="converted_input.json")
+    sub.add_argument("--confident", default="confident_results.json")
+    sub.add_argument("--llm", default="llm_results.json")
+    sub.add_argument("--output", default="dataset_result.json")
+    sub.set_defaults(func=run_merge)
+
+    sub = subparsers.add_parser("lookup", help="Show the top classes and codes for one diagnosis")
+    sub.add_argument("diagnosis", nargs="?", help="prompted for when omitted")
+    sub.add_argument("--timing", action="store_true", help="report elapsed time against the lookup budget")
+    sub.add_argument("--check-budget", action="store_true", help="exit with status 1 when over the lookup budget")
+    sub.set_defaults(func=run_lookup)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
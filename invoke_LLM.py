@@ -1,130 +1,280 @@
 import os
 import time
 import json
-from dotenv import load_dotenv
-from langchain_google_genai import ChatGoogleGenerativeAI
-
-# Load environment variables
-load_dotenv()
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-# Placeholder for the Google model instantiation to avoid API calls
-google_model = ChatGoogleGenerativeAI(
-    model="gemini-1.5-flash",
-    google_api_key=GEMINI_API_KEY,
-    temperature=0.2
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from types import SimpleNamespace
+from json_convert import batch_by_tokens, format_code_line, format_diagnosis_line
+
+# The Gemini client is created on first use so that importing this module stays cheap
+google_model = None
+
+def get_google_model():
+    global google_model
+    if google_model is None:
+        from dotenv import load_dotenv
+        from langchain_google_genai import ChatGoogleGenerativeAI
+
+        # Load environment variables
+        load_dotenv()
+        google_model = ChatGoogleGenerativeAI(
+            model="gemini-1.5-flash",
+            google_api_key=os.getenv("GEMINI_API_KEY"),
+            temperature=0.2,
+            # Retries are handled by invoke_with_retry so the two layers do not multiply
+            max_retries=0
+        )
+    return google_model
+
+class ReplayModel:
+    """Client for replay_server.py exposing the same invoke() as the Gemini model."""
+
+    def __init__(self, base_url, timeout=60):
+        self.url = base_url.rstrip("/") + "/invoke"
+        self.timeout = timeout
+
+    def invoke(self, messages):
+        # HTTP errors such as 429 and 500 raise urllib.error.HTTPError and are retried by the caller
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps({"messages": messages}).encode("utf-8"),
+            headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            body = json.load(response)
+        return SimpleNamespace(content=body["content"])
+
+def get_model(backend="gemini", replay_url="http://127.0.0.1:8765"):
+    if backend == "gemini":
+        return get_google_model()
+    if backend == "replay":
+        return ReplayModel(replay_url)
+    raise ValueError(f"Unknown model backend: {backend}")
+
+class RequestPacer:
+    """Spaces out LLM calls across all worker threads by at least `interval` seconds."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_send = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            send_at = max(now, self.next_send)
+            self.next_send = send_at + self.interval
+        time.sleep(send_at - now)
+
+def is_transient_error(error):
+    # Only rate limits, server errors and network problems are worth retrying
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    if isinstance(error, (urllib.error.URLError, TimeoutError, ConnectionError)):
+        return True
+    try:
+        from google.api_core import exceptions as google_exceptions
+    except ImportError:
+        return False
+    return isinstance(error, (
+        google_exceptions.TooManyRequests,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded
+    ))
+
+def retry_after_seconds(error):
+    # Retry-After is either a number of seconds or an HTTP date
+    headers = getattr(error, "headers", None)
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def invoke_with_retry(model, messages, max_retries, retry_backoff, pacer=None):
+    # Retry transient failures (rate limits, server errors, timeouts) with exponential backoff.
+    # Returns (response, retries); a raised error carries the retries made as error.retries
+    for attempt in range(max_retries + 1):
+        if pacer is not None:
+            pacer.wait()
+        try:
+            return model.invoke(messages), attempt
+        except Exception as error:
+            if attempt == max_retries or not is_transient_error(error):
+                error.retries = attempt
+                raise
+            delay = retry_backoff * 2 ** attempt
+            # Rate-limited HTTP responses say how long to wait
+            retry_after = retry_after_seconds(error)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            print(f"LLM call failed ({error}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+# Batches are sized by the estimated prompt tokens of the diagnoses, with a cap
+# on the number of diagnoses so the expected output stays short enough to parse
+MAX_BATCH_TOKENS = 3000
+MAX_BATCH_ITEMS = 20
+
+# Instructions sent ahead of every batch; {count} is the number of diagnoses in the batch
+PROMPT_HEADER = (
+    "You are an expert diagnosis classifier. You will receive {count} diagnoses, each with candidate codes. "
+    'If no code is found, output "No Match Found", and put suitable reasons in the "reason" field.\n\n'
+    "Select only the most relevant code for each diagnosis. Output each result in the format:\n"
+    'id: <patient_id> ; diagnosis: "<diagnosis>" ; code: "<selected code>" ; reason: "<reason>"\n\n'
+    "Return results as a single string with each entry separated by '\\n' with no extra information.\n\n"
+    "The descriptions of all candidate codes are listed once under 'Code descriptions'. "
+    "Each diagnosis lists only the codes it may choose from, enclosed by '----' for separation; "
+    "this is only in the input, not in the output.\n\n"
+    "Sample Input:\n"
+    "Code descriptions:\n"
+    "C43: Malignant melanoma of skin\n"
+    "C43.9: Malignant neoplasm: Malignant melanoma of skin, unspecified\n"
+    "D03: Melanoma in situ\n"
+    "Z85: Personal history of malignant neoplasm\n"
+    "----\n"
+    "id: 1; diagnosis: 'Malignant melanoma of skin'; codes: [C43, C43.9, D03, Z85]\n"
+    "----\n"
+    "Sample Output:\n"
+    'id: 1; diagnosis: Malignant melanoma of skin; code: C43.9; reason: As C43 is malignant melanoma of skin, and is unspecified, so C43.9 suits best.\n\n'
+    "You make sure that you output {count} results only, and the above is a sample, not to be confused with actual results.\n\n"
+    'This line is proof that the above is a sample, and anything written after this is actual query.\n\n'
 )
 
-def classify_all_diagnoses(input_json_path, output_json_path, log_txt_path):
+def build_prompt(patient_id, batch):
+    # Each code description is sent once per batch, however many diagnoses share it
+    code_descriptions = {}
+    for entry in batch:
+        code_descriptions.update(entry['codes'])
+
+    prompt = PROMPT_HEADER.format(count=len(batch))
+    prompt += "Code descriptions:\n"
+    for code, description in code_descriptions.items():
+        prompt += format_code_line(code, description)
+    prompt += "\n"
+
+    prompt += "Below are the diagnosis and possible codes:\n"
+    for entry in batch:
+        prompt += format_diagnosis_line(patient_id, entry['diagnosis'], entry['codes'])
+    return prompt
+
+def classify_all_diagnoses(input_json_path, output_json_path, log_txt_path, model=None,
+                           concurrency=1, request_delay=1, max_retries=3, retry_backoff=2):
     # Load JSON data
     with open(input_json_path, 'r') as file:
         data = json.load(file)
 
+    if model is None:
+        model = get_google_model()
+
+    # One pacer for all workers, so request_delay bounds the overall request rate
+    pacer = RequestPacer(request_delay)
+
+    # Collect every batch up front so that they can be sent concurrently
+    jobs = []
+    for patient_id, diagnoses in data.items():
+        diagnosis_batches = batch_by_tokens(patient_id, diagnoses, MAX_BATCH_TOKENS, MAX_BATCH_ITEMS)
+        for batch_idx, batch in enumerate(diagnosis_batches, start=1):
+            jobs.append((patient_id, batch_idx, len(diagnosis_batches), batch))
+
+    def send_batch(job):
+        patient_id, batch_idx, total_batches, batch = job
+        # Display batch processing progress
+        print(f"Processing Patient {patient_id}, Batch {batch_idx}/{total_batches}")
+
+        # Prepare prompt and message for the LLM
+        prompt = build_prompt(patient_id, batch)
+
+        # Send the prompt to the LLM, paced to stay under the API rate limit
+        messages = [{"role": "user", "content": prompt}]
+        try:
+            response, retries = invoke_with_retry(model, messages, max_retries, retry_backoff, pacer)
+        except Exception as error:
+            return None, getattr(error, "retries", 0), error
+        return response.content.strip(), retries, None
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        responses = list(executor.map(send_batch, jobs))
+    elapsed = time.perf_counter() - start_time
+
     # Initialize output structure and diagnostic log file
-    output_data = {}
+    output_data = {patient_id: [] for patient_id in data}
+    stats = {"batches": len(jobs), "diagnoses": sum(len(job[3]) for job in jobs),
+             "failed_batches": 0, "discrepancies": 0, "retries": 0, "elapsed_seconds": elapsed}
     with open(log_txt_path, 'w') as log_file:
 
-        for patient_id, diagnoses in data.items():
-            output_data[patient_id] = []
-            diagnosis_batches = [diagnoses[i:i + 20] for i in range(0, len(diagnoses), 20)]
-            total_batches = len(diagnosis_batches)
-
-            for batch_idx, batch in enumerate(diagnosis_batches, start=1):
-                # Display batch processing progress
-                print(f"Processing Patient {patient_id}, Batch {batch_idx}/{total_batches}")
-
-                # Prepare prompt and message for the LLM
-                        # Prepare prompt and message for the LLM
-                prompt = (
-                    f"You are an expert diagnosis classifier. You will receive {len(batch)} diagnoses, each with specific codes. "
-                    'If no code is found, output "No Match Found", and put suitable reasons in the "reason" field.\n\n'
-                    "Select only the most relevant code for each diagnosis. Output each result in the format:\n"
-                    'id: <patient_id> ; diagnosis: "<diagnosis>" ; code: "<selected code>" ; reason: "<reason>"\n\n'
-                    "Return results as a single string with each entry separated by '\\n' with no extra information.\n\n"
-                    "Each diagnosis in the input will be enclosed by '----' for separation; this is only in the input, not in the output. "
-                    "Use '\\n' to separate each diagnosis in the output.\n\n"
-                    "Sample Input:\n"
-                    "id: 1; diagnosis: Personal history of malignant melanoma of skin; codes: { \n"
-                    '    "C43": "Malignant Melanoma Of Skin",\n'
-                    '    "C43.8": "Malignant Neoplasm: Overlapping Malignant Melanoma Of Skin",\n'
-                    '    "C43.9": "Malignant Neoplasm: Malignant Melanoma Of Skin, Unspecified",\n'
-                    '    "D03": "Melanoma In Situ",\n'
-                    '    "D03.3": "Melanoma In Situ Of Other And Unspecified Parts Of Face",\n'
-                    '    "D03.0": "Melanoma In Situ Of Lip",\n'
-                    '    "Z85": "Personal History Of Malignant Neoplasm",\n'
-                    '    "Z85.3": "Personal History Of Malignant Neoplasm Of Breast",\n'
-                    '    "Z85.0": "Personal History Of Malignant Neoplasm Of Digestive Organs"\n'
-                    "}\n"
-                    "Sample Output:\n"
-                    'id: 1; diagnosis: Personal history of malignant melanoma of skin; code: C43.9; reason: As C43 is malignant melanoma of skin, and is unspecified, so C43.9 suits best.\n\n'
-                    f'You make sure that you output {len(batch)} results only, and the above is a sample, not to be confused with actual results.\n\n'
-                    'This line is proof that the above is a sample, and anything written after this is actual query.\n\n'
-                    'Below are the diagnosis and possible codes:\n'
-                )   
-
-                # Add actual diagnoses to the prompt
-                for entry in batch:
-                    diagnosis = entry['diagnosis']
-                    codes = entry['codes']
-                    prompt += f"----\nid: {patient_id}; diagnosis: '{diagnosis}'; codes: {{\n"
-                    for code, description in codes.items():
-                        prompt += f'    "{code}": "{description}",\n'
-                    prompt = prompt.rstrip(",\n") + "}\n----\n\n"
-
-                # Send the prompt to the LLM with a 1-second delay between calls
-                time.sleep(1)
-                messages = [{"role": "user", "content": prompt}]
-                response = google_model.invoke(messages)
-                fetched_response = response.content.strip()
-                # print(fetched_response)
-
-                # Parse and validate response
-                response_lines = fetched_response.split("\n")
-                if len(response_lines) != len(batch):
-                    # Log discrepancy and save input/output details if count mismatch occurs
-                    log_file.write(f"Discrepancy for Patient {patient_id}, Batch {batch_idx}\n")
-                    log_file.write(f"Expected Diagnoses Count: {len(batch)}\n")
-                    log_file.write(f"Received Response:\n{fetched_response}\n\n")
-                    print(f"Discrepancy for Patient {patient_id}, Batch {batch_idx}")
+        for (patient_id, batch_idx, _, batch), (fetched_response, retries, error) in zip(jobs, responses):
+            stats["retries"] += retries
+            if error is not None:
+                log_file.write(f"LLM call failed for Patient {patient_id}, Batch {batch_idx}: {error}\n\n")
+                print(f"LLM call failed for Patient {patient_id}, Batch {batch_idx}")
+                stats["failed_batches"] += 1
+                continue
+
+            # Parse and validate response
+            response_lines = fetched_response.split("\n")
+            if len(response_lines) != len(batch):
+                # Log discrepancy and save input/output details if count mismatch occurs
+                log_file.write(f"Discrepancy for Patient {patient_id}, Batch {batch_idx}\n")
+                log_file.write(f"Expected Diagnoses Count: {len(batch)}\n")
+                log_file.write(f"Received Response:\n{fetched_response}\n\n")
+                print(f"Discrepancy for Patient {patient_id}, Batch {batch_idx}")
+                stats["discrepancies"] += 1
+                continue
+            else:
+                print(f"Success for for Patient {patient_id}, Batch {batch_idx}")
+
+            # Process each response line and update output_data
+            for response_line in response_lines:
+                parts = response_line.split(";")
+
+                # Ensure there are exactly 4 parts to avoid IndexError
+                if len(parts) != 4:
+                    log_file.write(f"Unexpected format for line: {response_line}\n")
+                    continue  # Skip this line if the format is incorrect
+
+                try:
+                    # Extract each part and remove surrounding whitespaces
+                    id_part = parts[0].split(":")[1].strip()
+                    diagnosis_part = parts[1].split(":")[1].strip().strip('"')
+                    code_part = parts[2].split(":")[1].strip().strip('"')
+                    reason_part = parts[3].split(":")[1].strip().strip('"')
+
+                    # Add the cleaned data to output_data
+                    output_data[id_part].append({
+                        "diagnosis": diagnosis_part,
+                        "code": code_part,
+                        "reason": reason_part
+                    })
+                except (IndexError, KeyError):
+                    log_file.write(f"Could not parse line: {response_line}\n")
                     continue
-                else:
-                    print(f"Success for for Patient {patient_id}, Batch {batch_idx}")
-
-                # Process each response line and update output_data
-                for response_line in response_lines:
-                    parts = response_line.split(";")
-                    
-                    # Ensure there are exactly 4 parts to avoid IndexError
-                    if len(parts) != 4:
-                        log_file.write(f"Unexpected format for line: {response_line}\n")
-                        continue  # Skip this line if the format is incorrect
-                    
-                    try:
-                        # Extract each part and remove surrounding whitespaces
-                        id_part = parts[0].split(":")[1].strip()
-                        diagnosis_part = parts[1].split(":")[1].strip().strip('"')
-                        code_part = parts[2].split(":")[1].strip().strip('"')
-                        reason_part = parts[3].split(":")[1].strip().strip('"')
-
-                        # Add the cleaned data to output_data
-                        output_data[id_part].append({
-                            "diagnosis": diagnosis_part,
-                            "code": code_part,
-                            "reason": reason_part
-                        })
-                    except IndexError:
-                        log_file.write(f"IndexError encountered for line: {response_line}\n")
-                        continue
 
     # Save final output data to JSON
     with open(output_json_path, 'w') as output_file:
         json.dump(output_data, output_file, indent=4)
     print("Classification completed and output saved.")
+    print(f"Sent {stats['batches']} batches ({stats['diagnoses']} diagnoses) in {elapsed:.1f}s: "
+          f"{stats['batches'] / elapsed if elapsed > 0 else 0:.2f} batches/s, {stats['retries']} retries, "
+          f"{stats['failed_batches']} failed, {stats['discrepancies']} discrepancies")
+    return stats
 
-# Specify paths for your files
-input_json_path = "fetchable.json"
-output_json_path = "dataset_result.json"
-log_txt_path = "diagnostic_log.txt"
-
-# Run the classification function
-classify_all_diagnoses(input_json_path, output_json_path, log_txt_path)
+# Example usage
+if __name__ == "__main__":
+    input_json_path = "fetchable.json"  # LLM input from confident_match.py
+    output_json_path = "llm_results.json"  # Combined with confident_results.json by merge_results
+    log_txt_path = "diagnostic_log.txt"
+    classify_all_diagnoses(input_json_path, output_json_path, log_txt_path)
@@ -1,4 +1,95 @@
 import json
+import math
+import re
+
+# Rough characters-per-token ratio used to estimate prompt size without a tokenizer
+CHARS_PER_TOKEN = 4
+
+# Define a set of common stop words to ignore
+STOP_WORDS = {
+    "and", "or", "if", "in", "of", "the", "to", "is", "a", "an", "for", "on", "with",
+    "as", "by", "at", "it", "that", "this", "are", "was", "were", "be", "but", "not",
+    "from", "about", "which", "all", "these", "their", "its", "has", "have", "can"
+}
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def format_code_line(code, description):
+    # Single source of truth for how a code is rendered in the LLM prompt
+    return f"{code}: {description}\n"
+
+def format_diagnosis_line(patient_id, diagnosis, codes):
+    return f"----\nid: {patient_id}; diagnosis: '{diagnosis}'; codes: [{', '.join(codes)}]\n----\n\n"
+
+def word_stems(text):
+    # Lowercase, drop stop words and compare on a 5-letter prefix so that
+    # "arthropathy" and "arthropathies" are treated as the same word
+    words = re.findall(r'\b\w+\b', text.lower())
+    return {word[:5] for word in words if word not in STOP_WORDS}
+
+def normalize_description(description):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', description.lower()).split())
+
+def compress_codes(diagnosis, codes):
+    """Drop near-duplicate and low-score candidates from a {code: description} mapping.
+
+    - A specific code is dropped when neither it nor its class shares a word
+      with the diagnosis. Class codes always pass this filter.
+    - Among the remaining codes, a class code whose description is identical
+      (ignoring case and punctuation) to a later specific code is dropped in
+      favour of the specific code.
+    """
+    diagnosis_stems = word_stems(diagnosis)
+    relevant = {}
+    for code, description in codes.items():
+        if '.' in code:
+            class_description = codes.get(code.split('.')[0], '')
+            if not (diagnosis_stems & word_stems(description) or diagnosis_stems & word_stems(class_description)):
+                continue
+        relevant[code] = description
+
+    # Keep only the last surviving code for each normalized description
+    last_code_for = {}
+    for code, description in relevant.items():
+        last_code_for[normalize_description(description)] = code
+
+    return {
+        code: description for code, description in relevant.items()
+        if last_code_for[normalize_description(description)] == code
+    }
+
+def batch_by_tokens(patient_id, diagnoses, max_tokens, max_items):
+    """Group diagnoses into batches whose estimated prompt size stays within max_tokens.
+
+    Code descriptions are shared within a batch, so a code that was already
+    added by an earlier diagnosis in the same batch costs nothing extra.
+    """
+    def entry_cost(entry, batch_codes):
+        tokens = estimate_tokens(format_diagnosis_line(patient_id, entry['diagnosis'], entry['codes']))
+        tokens += sum(
+            estimate_tokens(format_code_line(code, description))
+            for code, description in entry['codes'].items() if code not in batch_codes
+        )
+        return tokens
+
+    batches = []
+    batch, batch_codes, batch_tokens = [], set(), 0
+    for entry in diagnoses:
+        entry_tokens = entry_cost(entry, batch_codes)
+
+        if batch and (batch_tokens + entry_tokens > max_tokens or len(batch) >= max_items):
+            batches.append(batch)
+            batch, batch_codes, batch_tokens = [], set(), 0
+            entry_tokens = entry_cost(entry, batch_codes)
+
+        batch.append(entry)
+        batch_codes.update(entry['codes'])
+        batch_tokens += entry_tokens
+
+    if batch:
+        batches.append(batch)
+    return batches
 
 def convert_format(input_json_path, output_json_path):
     # Load the input JSON data
@@ -7,28 +98,34 @@ def convert_format(input_json_path, output_json_path):
 
     # Prepare the results structure
     results = {}
+    original_codes = kept_codes = total_tokens = 0
 
     # Iterate through each diagnosis
     for key, diagnoses in input_data.items():
         results[key] = []  # Initialize a list for each key
         for diagnosis in diagnoses:
-            diagnosis_result = {
+            # Descriptions are kept in their original sentence case; title-casing
+            # every word only adds tokens to the prompt
+            codes = {code_entry['code']: code_entry['description'] for code_entry in diagnosis['codes']}
+
+            compressed = compress_codes(diagnosis["diagnosis"], codes)
+
+            results[key].append({
                 "diagnosis": diagnosis["diagnosis"],
-                "codes": {}
-            }
-            for code_entry in diagnosis['codes']:
-                code = code_entry['code']
-                description = code_entry['description']
-                # Normalize the description (capitalize appropriately)
-                normalized_description = ' '.join(word.capitalize() for word in description.split())
-                diagnosis_result["codes"][code] = normalized_description
+                "codes": compressed
+            })
+            original_codes += len(codes)
+            kept_codes += len(compressed)
 
-            results[key].append(diagnosis_result)
+            # Standalone token estimate for the entry, only reported as a summary
+            total_tokens += estimate_tokens(format_diagnosis_line(key, diagnosis["diagnosis"], compressed))
+            total_tokens += sum(estimate_tokens(format_code_line(code, description)) for code, description in compressed.items())
 
     # Save the results to the output JSON file
     with open(output_json_path, 'w') as output_file:
         json.dump(results, output_file, indent=4)
 
+    print(f"Kept {kept_codes}/{original_codes} candidate codes, ~{total_tokens} tokens in total")
     print(f"Converted format saved to {output_json_path}")
 
 # Example usage
@@ -1,11 +1,5 @@
 import json
 import re
-from nltk.stem import PorterStemmer
-from nltk.tokenize import word_tokenize
-from nltk.metrics import edit_distance
-
-# Initialize required components
-stemmer = PorterStemmer()
 
 # Define a set of common stop words to ignore
 STOP_WORDS = {
@@ -24,26 +18,6 @@ def preprocess_input(input_string):
             unique_filtered_words.append(word)
     return unique_filtered_words
 
-def normalize_token(token):
-    return re.sub(r'[^a-zA-Z]', '', token.lower())
-
-def compute_similarity_score(str1, str2):
-    tokens1 = [normalize_token(token) for token in word_tokenize(str1)]
-    tokens2 = [normalize_token(token) for token in word_tokenize(str2)]
-    
-    match_count = 0
-    total_tokens = len(tokens1) + len(tokens2)
-
-    for token1 in tokens1:
-        for token2 in tokens2:
-            lev_distance = edit_distance(token1, token2)
-            lev_score = 1 - (lev_distance / max(len(token1), len(token2))) if max(len(token1), len(token2)) > 0 else 1
-
-            if lev_score > 0.8:
-                match_count += 1
-
-    return match_count / total_tokens if total_tokens > 0 else 1.0
-
 def compute_scores(input_words, word_frequencies):
     scores = {}
 
@@ -67,8 +41,7 @@ def get_top_k_subclasses(scores, icd10_data, top_k=3):
         specific_codes = [
             {
                 "code": specific_code,
-                "description": specific_description,
-                "similarity_score": compute_similarity_score(specific_description, description)
+                "description": specific_description
             }
             for specific_code, specific_description in specifics.items()
         ]
@@ -81,7 +54,7 @@ def get_top_k_subclasses(scores, icd10_data, top_k=3):
 
     return top_k_results
 
-def main():
+def main(diagnosis=None):
     # Load the word frequencies from JSON
     with open('icd10_word_frequencies_custom.json', 'r') as freq_file:
         word_frequencies = json.load(freq_file)
@@ -90,8 +63,9 @@ def main():
     with open('icd10_data.json', 'r') as data_file:
         icd10_data = json.load(data_file)
 
-    # Take diagnosis input from the user
-    diagnosis = input("Enter a diagnosis description: ")
+    # Take diagnosis input from the user unless one was passed in
+    if diagnosis is None:
+        diagnosis = input("Enter a diagnosis description: ")
 
     # Preprocess the input
     input_words = preprocess_input(diagnosis)
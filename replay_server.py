@@ -0,0 +1,134 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Matches one diagnosis line of the prompt built by invoke_LLM.build_prompt
+DIAGNOSIS_PATTERN = re.compile(r"^id: (\S+); diagnosis: '(.*)'; codes: \[", re.MULTILINE)
+
+def load_recorded_responses(recorded_json_path):
+    # The LLM echoes the diagnosis with surrounding quotes, so strip them for lookup
+    with open(recorded_json_path, 'r') as recorded_file:
+        recorded_data = json.load(recorded_file)
+
+    recorded = {}
+    for patient_id, results in recorded_data.items():
+        for result in results:
+            recorded[(patient_id, result["diagnosis"].strip().strip("'\""))] = (result["code"], result["reason"])
+    return recorded
+
+def replay_response(prompt, recorded):
+    # Only the part after the sample block holds the actual query
+    query = prompt.split("Below are the diagnosis and possible codes:", 1)[-1]
+
+    lines = []
+    for patient_id, diagnosis in DIAGNOSIS_PATTERN.findall(query):
+        code, reason = recorded.get((patient_id, diagnosis), ("No Match Found", "No recorded response for this diagnosis."))
+        # Keep the separators of the response format out of the free text
+        reason = reason.replace(";", ",").replace(":", ",")
+        lines.append(f'id: {patient_id}; diagnosis: "{diagnosis}"; code: "{code}"; reason: "{reason}"')
+    return "\n".join(lines)
+
+class ReplayState:
+    """Recorded responses plus the latency, error and rate-limit settings shared by all requests."""
+
+    def __init__(self, recorded, latency, jitter, error_rate, rate_limit, seed):
+        self.recorded = recorded
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.request_times = deque()
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0}
+
+    def admit(self):
+        # Returns "rate_limited", "error" or "ok" for the next request
+        with self.lock:
+            self.counts["requests"] += 1
+            now = time.monotonic()
+            if self.rate_limit > 0:
+                while self.request_times and now - self.request_times[0] >= 1:
+                    self.request_times.popleft()
+                if len(self.request_times) >= self.rate_limit:
+                    self.counts["rate_limited"] += 1
+                    return "rate_limited"
+                self.request_times.append(now)
+            if self.random.random() < self.error_rate:
+                self.counts["errors"] += 1
+                return "error"
+            self.counts["ok"] += 1
+            return "ok"
+
+    def delay(self):
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter) if self.jitter > 0 else 0
+        return max(0.0, self.latency + jitter)
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.state.counts)
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/invoke":
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        messages = json.loads(self.rfile.read(length))["messages"]
+        prompt = "\n".join(message["content"] for message in messages)
+
+        outcome = self.state.admit()
+        if outcome == "rate_limited":
+            self.send_json(429, {"error": "Rate limit exceeded"}, {"Retry-After": "1"})
+            return
+
+        time.sleep(self.state.delay())
+        if outcome == "error":
+            self.send_json(500, {"error": "Injected server error"})
+            return
+
+        self.send_json(200, {"content": replay_response(prompt, self.state.recorded)})
+
+    def log_message(self, format, *args):
+        # Keep the console quiet during load tests
+        pass
+
+def main(recorded_json_path, host="127.0.0.1", port=8765, latency=1.0, jitter=0.0,
+         error_rate=0.0, rate_limit=0, seed=0):
+    recorded = load_recorded_responses(recorded_json_path)
+    ReplayHandler.state = ReplayState(recorded, latency, jitter, error_rate, rate_limit, seed)
+
+    server = ThreadingHTTPServer((host, port), ReplayHandler)
+    print(f"Replaying {len(recorded)} recorded responses on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Request counts: {ReplayHandler.state.counts}")
+
+# Example usage
+if __name__ == "__main__":
+    recorded_json_path = 'reference_results.json'  # Earlier LLM results to replay
+    main(recorded_json_path)
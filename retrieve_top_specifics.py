@@ -1,16 +1,23 @@
 import json
 import re
-from nltk.stem import PorterStemmer
-from nltk.tokenize import word_tokenize
-from nltk.metrics import edit_distance
 
-# Initialize required components
-stemmer = PorterStemmer()
+# NLTK is slow to import, so it is loaded on the first similarity computation
+nltk_functions = None
+
+def load_nltk():
+    global nltk_functions
+    if nltk_functions is None:
+        from nltk.tokenize import word_tokenize
+        from nltk.metrics import edit_distance
+        nltk_functions = (word_tokenize, edit_distance)
+    return nltk_functions
 
 def normalize_token(token):
     return re.sub(r'[^a-zA-Z]', '', token.lower())
 
 def compute_similarity_score(str1, str2):
+    word_tokenize, edit_distance = load_nltk()
+
     tokens1 = [normalize_token(token) for token in word_tokenize(str1)]
     tokens2 = [normalize_token(token) for token in word_tokenize(str2)]
     
@@ -78,16 +85,24 @@ def build_new_json(top_results, icd10_data):
             })
     return new_results
 
-# Example usage:
-# Load the JSON files
-with open("top_subclass_results_ln_weighted_4_100_updGlobal.json") as f:
-    top_results = json.load(f)
-with open("icd10_data.json") as f:
-    icd10_data = json.load(f)
+def main(input_json_path, output_json_path):
+    # Load the JSON files
+    with open(input_json_path) as f:
+        top_results = json.load(f)
+    with open("icd10_data.json") as f:
+        icd10_data = json.load(f)
+
+    # Process the JSON data
+    new_json_data = build_new_json(top_results, icd10_data)
+
+    # Save the output
+    with open(output_json_path, "w") as f:
+        json.dump(new_json_data, f, indent=2)
 
-# Process the JSON data
-new_json_data = build_new_json(top_results, icd10_data)
+    print(f"Reduced match results saved to {output_json_path}")
 
-# Save the output
-with open("reduced_match_results.json", "w") as f:
-    json.dump(new_json_data, f, indent=2)
+# Example usage
+if __name__ == "__main__":
+    input_json_path = "top_subclass_results.json"  # Output of top_class_search.py
+    output_json_path = "reduced_match_results.json"
+    main(input_json_path, output_json_path)